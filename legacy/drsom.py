@@ -83,7 +83,7 @@ class DRSOMF(torch.optim.Optimizer):
     self._params = self.get_params()
     for p in self._params:
       # keep momentum
-      self.state[p]['momentum'] = torch.zeros_like(p.data, requires_grad=True)
+      self.state[p]['momentum'] = torch.zeros_like(p.data)
     
     #
     self._numel_cache = None
@@ -343,9 +343,8 @@ class DRSOMF(torch.optim.Optimizer):
       alpha1, alpha2 = self.alpha
       
       # build direction
-      flat_new_d = torch.zeros_like(flat_d, requires_grad=False)
-      flat_new_d.add_(flat_g / g_norm, alpha=-alpha1).add_(flat_d / d_norm, alpha=alpha2)
-      flat_new_p = torch.zeros_like(flat_p, requires_grad=False).copy_(flat_p).add_(flat_new_d)
+      flat_new_d = (flat_g / g_norm).mul_(-alpha1).add_(flat_d / d_norm, alpha=alpha2)
+      flat_new_p = flat_p + flat_new_d
       
       # accept or not？
       loss_est = self._directional_evaluate(closure, flat_new_p, flat_new_d)
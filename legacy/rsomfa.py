@@ -58,7 +58,7 @@ class RSOMF(torch.optim.Optimizer):
     self._params = self.get_params()
     for p in self._params:
       # keep momentum
-      self.state[p]['momentum'] = torch.zeros_like(p.data, requires_grad=True)
+      self.state[p]['momentum'] = torch.zeros_like(p.data)
     
     #
     self._numel_cache = None
@@ -4,13 +4,12 @@ the original dimension-reduced second-order method (DRSOM) in radius free mode
 @note:
   This is a beta implementation of (Mini-batch, Radius-Free) DRSOM.
   - the options to run DRSOM can be controlled by the environment variables, see `drsom_utils.py`
-  - we treat the parameters as a set of tensors (no flatten() anymore)
+  - the parameters are kept as a set of tensors, while the directions live in
+    one flat (dim x n) buffer with a view per parameter (for the GEMM/GEMV's);
+    all trainable parameters must thus share one dtype and one device
 """
-from pprint import pprint
 from typing import Optional, List
 
-import pandas as pd
-
 from .drsom_utils import *
 from .drsom_utils import DRSOMDecayRules
 
@@ -29,6 +28,7 @@ class DRSOMB(torch.optim.Optimizer):
         mode: Optional[DRSOMMode] = DRSOMMode(0),
         thetas=(0.99, 0.999),
         eps=1e-8,
+        compile_closure=False,
         **kwargs,
     ):
         """
@@ -46,29 +46,90 @@ class DRSOMB(torch.optim.Optimizer):
           hessian_window: window size to keep last k hessian information
           thetas: weight decay params (like betas for Adam)
           eps: ...
+          compile_closure: compile the closure by torch.compile (needs torch>=2.0),
+            the closure (and the model) must then be traceable by dynamo;
+            only for the interpolation mode without DRSOM_DEBUG_Q_CHECK
+            (the AD/FD modes and the debug check of Q need a double backward,
+            which compiled graphs do not support)
         """
         __unused = kwargs
         defaults = dict(betas=thetas, eps=eps)
         # params = model.parameters()
         super(DRSOMB, self).__init__(params, defaults)
+        if DRSOM_DETECT_ANOMALY:
+            # set once (a global switch), it slows down every backward op
+            torch.autograd.set_detect_anomaly(True)
         self.mode = mode
         self.qpsolver = qpsolver
         self.qpmode = qpmode
         self.directions = mode.get_directions()
         self.bool_normalize = normalize
         self.fixed_momentum = fixed_momentum
+        if compile_closure and qpmode != DRSOMModeQP.Interpolation:
+            raise ValueError("compile_closure needs the interpolation mode")
+        if compile_closure and DRSOM_DEBUG_Q_CHECK:
+            raise ValueError("compile_closure does not support DRSOM_DEBUG_Q_CHECK")
+        self.compile_closure = compile_closure and hasattr(torch, "compile")
         ##########################
-        # AD hvps
+        # parameters & states
         ##########################
-        self.Hv = None
         self._params = self.get_params()
+        if not self._params:
+            raise ValueError("DRSOM got no parameters that require grad")
+        if len({(p.dtype, p.device) for p in self._params}) > 1:
+            raise ValueError("DRSOM needs all parameters on one device, of one dtype")
         for p in self._params:
             # keep momentum
+            #   (a plain buffer, no gradient is ever taken w.r.t. it)
             for k in self.directions:
-                self.state[p][k] = torch.zeros_like(p.data, requires_grad=True)
-
-        #
-        self._numel_cache = None
+                self.state[p][k] = torch.zeros_like(p.data)
+        # the momentum buffers as lists aligned with self._params (for foreach ops)
+        self._state_lists = {
+            k: [self.state[p][k] for p in self._params] for k in self.directions
+        }
+        # fixed momentum buffers (only if used)
+        self._fm_bufs = []
+        if fixed_momentum >= 0:
+            for p in self._params:
+                self.state[p]["fixed_momentum_buffer"] = torch.zeros_like(p.data)
+            self._fm_bufs = [
+                self.state[p]["fixed_momentum_buffer"] for p in self._params
+            ]
+        # total number of (trainable) entries
+        #   and the offsets of the parameters in a flattened vector
+        self._numel = sum(p.numel() for p in self._params)
+        self._offsets = np.cumsum([0] + [p.numel() for p in self._params])
+        # the directions live in one persistent (dim x n) buffer,
+        #   the direction i is the list of views self._D_views[i]
+        #   (aligned with self._params) into its i-th row
+        p0 = self._params[0]
+        self._dim = 1 if fixed_momentum >= 0 else 1 + len(self.directions)
+        self._D = torch.zeros(
+            (self._dim, self._numel), dtype=p0.dtype, device=p0.device
+        )
+        self._D_views = [self._as_views(v) for v in self._D]
+        # identity of the subspace (batched HVP seeds, G of the plain solvers)
+        self._eye = torch.eye(self._dim, dtype=p0.dtype, device=p0.device)
+        # upper-triangular index pairs of the subspace (natural basis & Q),
+        #   and the mask of the diagonal ones
+        self._triu = np.triu_indices(self._dim)
+        self._triu_diag = self._triu[0] == self._triu[1]
+        # persistent buffers of the flat gradient (only needed by the fixed
+        #   momentum, otherwise -g is kept in self._D), the trial step
+        #   and the parameter copy, reused across steps and trials
+        if fixed_momentum >= 0:
+            self._g_flat = torch.zeros(self._numel, dtype=p0.dtype, device=p0.device)
+            self._g_views = self._as_views(self._g_flat)
+        # the scale of -g in self._D (its norm if normalized)
+        self._g_scale = 1.0
+        # the norm of g, computed once per step by _bool_grad_vanish
+        self._g_norm = None
+        self._d_new_flat = torch.zeros(self._numel, dtype=p0.dtype, device=p0.device)
+        self._d_new = self._as_views(self._d_new_flat)
+        self._p_copy = [
+            torch.empty_like(p, memory_format=torch.contiguous_format)
+            for p in self._params
+        ]
         ##########################
         # DRSOM only params
         ##########################
@@ -108,6 +169,9 @@ class DRSOMB(torch.optim.Optimizer):
         self.decayrule: DRSOMDecayRules = decayrules
         self.adjrule: DRSOMAdjustRules = adjrules
         self.delta = 1e-3
+        # (pseudo-)inverses of the interpolation basis,
+        #   keyed by (dim, multiples, delta)
+        self._K_pinv_cache = {}
 
         ##########################
         # weight decay of the past
@@ -118,18 +182,11 @@ class DRSOMB(torch.optim.Optimizer):
         self.logline = {}
         #########################
 
-    def update_fixed_momentum(self, grad, state, momentum):
-        if "fixed_momentum_buffer" not in state:
-            state["fixed_momentum_buffer"] = torch.zeros_like(grad, device=grad.device)
-        buf = state["fixed_momentum_buffer"]
-        buf.mul_(momentum).add_(-1.0, grad)
-        return buf
-
     def use_fixed_momentum(self, momentum):
-        return {
-            p: self.update_fixed_momentum(p.grad.data, self.state[p], momentum)
-            for p in self._params
-        }
+        # buf <- momentum * buf - g, batched over all parameters
+        torch._foreach_mul_(self._fm_bufs, momentum)
+        torch._foreach_add_(self._fm_bufs, self._grads(), alpha=-1.0)
+        return self._fm_bufs
 
     def get_name(self):
         return f"drsom-b@{self.qpsolver.name}@{self.qpmode.name}d@{self.mode.name}:{self.decayrule.__str__()}-{self.adjrule.__str__()}"
@@ -142,40 +199,61 @@ class DRSOMB(torch.optim.Optimizer):
             p for group in self.param_groups for p in group["params"] if p.requires_grad
         ]
 
+    @torch.no_grad()
     def _clone_param(self):
-        return [p.clone(memory_format=torch.contiguous_format) for p in self._params]
+        foreach_copy_(self._p_copy, self._params)
+        return self._p_copy
 
     @torch.no_grad()
     def _set_param(self, params_data):
-        for p, pdata in zip(self._params, params_data):
-            p.copy_(pdata)
+        foreach_copy_(self._params, params_data)
 
     @torch.no_grad()
     def _use_new_d(self, d_new):
-        for p in self._params:
-            p.add_(d_new[p])
+        torch._foreach_add_(self._params, d_new)
 
-    def _bool_grad_vanish(self, p):
-        return p.grad is None or torch.linalg.norm(p.grad) < 1e-8
+    def _as_views(self, flat):
+        """
+        split a flat vector into views aligned with self._params
+        """
+        return [
+            flat[o : o + p.numel()].view_as(p)
+            for o, p in zip(self._offsets, self._params)
+        ]
+
+    def _grads(self):
+        # the gradients aligned with self._params,
+        #   a parameter unused by the closure (grad is None) has a zero gradient
+        return [torch.zeros_like(p) if p.grad is None else p.grad for p in self._params]
+
+    @torch.no_grad()
+    def _bool_grad_vanish(self):
+        # the norm of the whole gradient by a single fused reduction,
+        #   kept in self._g_norm for the normalization of -g
+        grads = [p.grad for p in self._params if p.grad is not None]
+        if not grads:
+            return True
+        norms = torch._foreach_norm(grads)
+        self._g_norm = torch.linalg.vector_norm(torch.stack(norms))
+        return self._g_norm.item() < 1e-8
 
     @torch.no_grad()
     def _clear_momentum(self):
         # only has globally state
-        for p in self._params:
-            for k in self.directions:
-                if k in self.state[p]:
-                    self.state[p][k].zero_()
+        for k in self.directions:
+            torch._foreach_zero_(self._state_lists[k])
 
     @drsom_timer
     def _save_momentum(self, vlist, key):
         """
         saving momentum
         """
+        # the same running average as update_running_stat,
+        #   m <- rate * m + (1 - rate) * v, batched over all parameters
+        rate = self.decayrule.qp_rate
         with torch.no_grad():
-            for idx, p in enumerate(self._params):
-                update_running_stat(
-                    vlist[p], self.state[p][key], self.decayrule.qp_rate
-                )
+            torch._foreach_mul_(self._state_lists[key], rate)
+            torch._foreach_add_(self._state_lists[key], vlist, alpha=1 - rate)
 
     @torch.no_grad()
     def solve_alpha(self, Q, c, tr):
@@ -189,57 +267,100 @@ class DRSOMB(torch.optim.Optimizer):
         ####################################
         # compute estimate decrease
         ####################################
-        trs_est = -1 / 2 * (self.Q @ self.alpha).dot(self.alpha) - self.c.dot(
-            self.alpha
-        )
+        trs_est = trs_estimate(self.Q, self.c, self.alpha)
         if DRSOM_VERBOSE:
             self.logline["Δ"] = "{:+.2e}".format(self.radius)
             self.logline["δ"] = "{:+.2e}".format(self.alpha_norm)
         return trs_est
 
     @drsom_timer
-    def hv(self, directions):
+    def hv(self, flat_dirs):
         """
-        exact metric
+        exact metric,
+          the Hessian-vector products of all directions are evaluated
+          by a single (batched) backward pass.
         Args:
-          p:
-          v:
+          flat_dirs: the (dim x n) direction matrix
 
         Returns:
+          the (dim x n) matrix of the flattened H @ directions[i]
+        """
+        dim = flat_dirs.shape[0]
+        # gv = D g by a single GEMV, keeping the graph of g
+        gv = flat_dirs @ torch.cat([g.reshape(-1) for g in self._grads()])
+        Hv = torch.autograd.grad(
+            gv,
+            self._params,
+            grad_outputs=self._eye[:dim, :dim],
+            is_grads_batched=True,
+            retain_graph=True,
+            allow_unused=True,
+        )
+        return torch.cat(
+            [
+                (
+                    p.new_zeros(dim, p.numel())
+                    if hv is None
+                    else hv.detach().reshape(dim, -1)
+                )
+                for p, hv in zip(self._params, Hv)
+            ],
+            dim=1,
+        )
 
+    @drsom_timer
+    def hv_fwd(self, functional, flat_dirs):
         """
+        exact metric by forward-over-reverse,
+          the jvp of the gradient function, batched over the directions by vmap;
+          no create_graph is needed in the closure.
+        Args:
+          functional: the loss as a pure function of the parameters,
+            given as `closure.functional`
+          flat_dirs: the (dim x n) direction matrix
 
-        gv = [torch.mul(p.grad, directions[p]).sum() for p in self._params]
-        return torch.autograd.grad(
-            gv, self._params, create_graph=True, retain_graph=True
-        )
+        Returns:
+          the (dim x n) matrix of the flattened H @ directions[i]
+        """
+        dim = flat_dirs.shape[0]
+        params = [p.detach() for p in self._params]
+        tangents = [
+            flat_dirs[:, o : o + p.numel()].reshape(dim, *p.shape)
+            for o, p in zip(self._offsets, self._params)
+        ]
+        grad_fn = torch.func.grad(functional)
+        Hv = torch.func.vmap(
+            lambda *v: torch.func.jvp(grad_fn, (params,), (list(v),))[1]
+        )(*tangents)
+        return torch.cat([hv.reshape(dim, -1) for hv in Hv], dim=1)
 
     @drsom_timer
-    def compute_Q_via_hvp(self, directions, style):
+    def compute_Q_via_hvp(self, directions, flat_dirs, style, functional=None):
         dim = len(directions)
-        Q = torch.zeros((dim, dim), requires_grad=False, device="cpu")
-        if self.Hv is None:
-            self.Hv = [[] for _ in range(dim)]
-        for i in range(dim):
-            if style == 0:
-                self.Hv[i] = self.hv(directions[i])
-            elif style == 1:
-                raise ValueError("the finite diff option is unused,")
+        if style == 0:
+            # the flattened Hv's (dim x n), aligned with flat_dirs,
+            #   kept local so they are dropped as soon as Q is formed
+            if functional is not None and hasattr(torch, "func"):
+                flat_Hv = self.hv_fwd(functional, flat_dirs)
             else:
-                raise ValueError("not implemented,")
-        for i in range(dim):
-            for j in range(i, dim):
-                for idx, p in enumerate(self._params):
-                    u = directions[i][p]
-                    hv = self.Hv[j][idx]
-                    Q[i, j] += torch.mul(u, hv).sum().cpu().detach()
-        for i in range(dim):
-            for j in range(i):
-                Q[i, j] = Q[j, i]
-        return Q
+                flat_Hv = self.hv(flat_dirs)
+        elif style == 1:
+            raise ValueError("the finite diff option is unused,")
+        else:
+            raise ValueError("not implemented,")
+        if dim == 2:
+            # the common case (-g and momentum), unrolled
+            q00 = torch.dot(flat_dirs[0], flat_Hv[0])
+            q01 = torch.dot(flat_dirs[0], flat_Hv[1])
+            q11 = torch.dot(flat_dirs[1], flat_Hv[1])
+            return torch.stack([q00, q01, q01, q11]).view(2, 2)
+        # a single GEMM, kept on the device
+        Q = flat_dirs @ flat_Hv.T
+        # keep symmetry
+        return (Q + Q.T) / 2
 
     @drsom_timer
-    def build_natural_basis(self, v):
+    def build_natural_basis(self, a):
         """
           function build_natural_basis(v)
               _len = length(v)
@@ -248,20 +369,57 @@ class DRSOMB(torch.optim.Optimizer):
                    for j = i:_len]
               return a
           end
+        vectorized over all samples
+        Args:
+          a: k x dim samples
         Returns:
+          the k x dim*(dim+1)/2 natural basis, one row per sample
         """
-        _len = len(v)
-        a = [
-            v[i] * v[j] / 2 if i == j else v[i] * v[j]
-            for i in range(0, _len)
-            for j in range(i, _len)
-        ]
-        return a
+        A = np.asarray(a)
+        iu = self._triu
+        # only the upper-triangular products, no k x dim x dim outer product
+        K = A[:, iu[0]] * A[:, iu[1]]
+        K[:, self._triu_diag] *= 0.5
+        return K
+
+    @drsom_timer
+    def _directional_evaluate_batched(self, functional, flat_dirs, a):
+        """
+        evaluate the loss at the trial steps sum_i a[j][i] * directions[i]
+          for all j at once.
+        Args:
+          functional: the loss as a pure function of the parameters,
+            given as `closure.functional`; it is batched by torch.func.vmap,
+            so it must not update tensors in-place (e.g., BatchNorm statistics).
+          flat_dirs: the (dim x n) direction buffer
+          a: k x dim coefficients of the trial steps
+
+        Returns:
+          a (k, ) tensor of the losses on cpu
+        """
+        k = len(a)
+        with torch.no_grad():
+            # all trial steps by a single GEMM (k x n)
+            flat_deltas = (
+                torch.as_tensor(
+                    np.asarray(a), dtype=flat_dirs.dtype, device=flat_dirs.device
+                )
+                @ flat_dirs
+            )
+            deltas = [
+                flat_deltas[:, o : o + p.numel()].reshape(k, *p.shape)
+                for o, p in zip(self._offsets, self._params)
+            ]
+            losses = torch.func.vmap(
+                lambda *d: functional([p + dp for p, dp in zip(self._params, d)])
+            )(*deltas)
+        return losses.cpu()
 
     @drsom_timer
     def compute_Q_via_interpolation(
         self,
         directions,
+        flat_dirs,
         fx,
         c: Optional[torch.Tensor],
         p_copy=None,
@@ -315,41 +473,53 @@ class DRSOMB(torch.optim.Optimizer):
         ff = [np.dot(v, c_arr) for v in a]
         k = len(a)
         df = np.zeros((k, 1))
-        K = np.array([self.build_natural_basis(v) for v in a])
-        d_new = {p: torch.zeros_like(p, requires_grad=False) for p in self._params}
-        for j in range(k):
-            for p in self._params:
-                d_new[p].zero_()
-                for i in range(dim):
-                    u = directions[i][p]
-                    d_new[p].add_(u, alpha=a[j][i])
-
-            self._use_new_d(d_new)
-            loss_est = closure(backward=False).detach().cpu()
-            df[j] = loss_est - fx - ff[j]
-            # set back
+        # the basis K only depends on the sampling pattern,
+        #   so its pseudo-inverse is computed once and reused;
+        #   K may be rank-deficient (e.g., dim = 3), where only the pseudo-inverse
+        #   gives the (finite) minimum-norm least-squares solution, like lstsq
+        key = (dim, multiples, delta)
+        if key not in self._K_pinv_cache:
+            self._K_pinv_cache[key] = np.linalg.pinv(self.build_natural_basis(a))
+        K_pinv = self._K_pinv_cache[key]
+        functional = getattr(closure, "functional", None)
+        if functional is not None and hasattr(torch, "func"):
+            # evaluate all k trial steps in one batched forward pass
+            loss_est = self._directional_evaluate_batched(functional, flat_dirs, a)
+            df[:, 0] = loss_est.numpy() - fx - np.array(ff)
+        else:
+            for j in range(k):
+                aj = torch.as_tensor(
+                    a[j], dtype=flat_dirs.dtype, device=flat_dirs.device
+                )
+                torch.mv(flat_dirs.T, aj, out=self._d_new_flat)
+
+                self._use_new_d(self._d_new)
+                loss_est = closure(backward=False).item()
+                df[j] = loss_est - fx - ff[j]
+                # set back by subtracting the same step (no copy of the model)
+                with torch.no_grad():
+                    torch._foreach_sub_(self._params, self._d_new)
+            # remove the rounding drift of the add/sub pairs by a single copy
             self._set_param(p_copy)
 
-        m, n = K.shape
-        if m == n:
-            q = np.linalg.solve(K, df)
-        else:
-            q, *_ = np.linalg.lstsq(K, df)
-        q = q.flatten()
-        Q = torch.zeros((dim, dim), requires_grad=False, device="cpu")
-        for i in range(dim):
-            for j in range(i, dim):
-                Q[i, j] = q[int(j * (j + 1) / 2) + i]
-        for i in range(dim):
-            for j in range(0, i):
-                Q[i, j] = Q[j, i]
-        del d_new
-        if DRSOM_VERBOSE:
+        # least-squares (or exact if K is square) solution of K q = df,
+        #   a single small matrix-vector product
+        q = (K_pinv @ df).flatten()
+        # q is ordered as the columns of the basis (np.triu_indices),
+        #   fill both triangles at once
+        iu = self._triu
+        Q = np.zeros((dim, dim))
+        Q[iu] = q
+        Q[iu[::-1]] = q
+        Q = torch.from_numpy(Q).to(c.dtype)
+        if DRSOM_DEBUG_Q_CHECK and self.iter % DRSOM_DEBUG_Q_CHECK == 0:
             ###########################################################
             # compare with HVP
             _ = closure(backward=True)
-            Q1 = self.compute_Q_via_hvp(directions, style=0)
-            q1 = Q1.triu().cpu().detach().numpy()
+            Q1 = self.compute_Q_via_hvp(
+                directions, flat_dirs, style=0, functional=functional
+            )
+            q1 = Q1.triu().cpu().numpy()
             q1 = q1[q1.nonzero()]
             print(q1)
             print(q)
@@ -359,34 +529,20 @@ class DRSOMB(torch.optim.Optimizer):
     def update_trust_region(self, p_copy, directions, fx=0.0, closure=None):
 
         __unused = p_copy
-        # each direction is a list of tensors
+        # each direction is a list of tensors (aligned with self._params),
+        #   i.e., views into the rows of the flat buffer self._D (dim x n)
         dim = len(directions)
-        # construct G (the inner products)
-        G = torch.zeros((dim, dim), requires_grad=False, device="cpu")
-        if self.qpsolver in {DRSOMQPSolver.QRegP, DRSOMQPSolver.TRSP}:
-            for i in range(dim):
-                for j in range(i, dim):
-                    for p in self._params:
-                        v = directions[i][p]
-                        u = directions[j][p]
-                        # compute G[i,j]
-                        G[i, j] += torch.mul(u, v).sum().cpu().detach()
-            # keep symmetry
-            for i in range(dim):
-                for j in range(i):
-                    G[i, j] = G[j, i]
-
+        flat_dirs = self._D
+        # construct G (the inner products) and c
+        if self.fixed_momentum < 0:
+            # the first direction is -g / scale, so c = D g = -scale * G[:, 0]
+            G = flat_dirs @ flat_dirs.T
+            c = -self._g_scale * G[:, 0]
         else:
+            G, c = fused_inner(flat_dirs, self._g_flat)
+        if self.qpsolver not in {DRSOMQPSolver.QRegP, DRSOMQPSolver.TRSP}:
             # simply use the eye matrix
-            for i in range(dim):
-                G[i, i] = 1.0
-
-        # construct c
-        c = torch.zeros(dim, requires_grad=False, device="cpu")
-        for i in range(dim):
-            for p in self._params:
-                u = directions[i][p]
-                c[i] += torch.mul(p.grad, u).sum().cpu().detach()
+            G = self._eye[:dim, :dim]
 
         if self.iter % self.decayrule.qp_freq != 0:
             # if set freq = 1
@@ -395,15 +551,25 @@ class DRSOMB(torch.optim.Optimizer):
         else:
             if self.qpmode == DRSOMModeQP.FiniteDiff:
                 with torch.enable_grad():
-                    Q = self.compute_Q_via_hvp(directions, 1)
+                    Q = self.compute_Q_via_hvp(directions, flat_dirs, 1)
                     self.zero_grad()
             elif self.qpmode == DRSOMModeQP.AutomaticDiff:
                 with torch.enable_grad():
-                    Q = self.compute_Q_via_hvp(directions, 0)
+                    Q = self.compute_Q_via_hvp(
+                        directions,
+                        flat_dirs,
+                        0,
+                        functional=getattr(closure, "functional", None),
+                    )
                     self.zero_grad()
             elif self.qpmode == DRSOMModeQP.Interpolation:
+                # the interpolation works on the host,
+                #   so c and G are moved there first (in one copy)
+                cG = to_host(torch.vstack([c, G]))
+                c, G = cG[0], cG[1:]
                 Q = self.compute_Q_via_interpolation(
                     directions,
+                    flat_dirs,
                     p_copy=p_copy,
                     closure=closure,
                     fx=fx,
@@ -412,32 +578,62 @@ class DRSOMB(torch.optim.Optimizer):
                 )
             else:
                 raise ValueError("not handled yet")
-            self.ghg = (Q[0, 0] + self.ghg * self.iter) / (self.iter + 1)
-
             # compute Q/c/G
-            self.Q = Q
-            self.c = c
-            self.G = G
+            #   they are assembled on the parameters' device (or on the host
+            #   for interpolation), the (tiny) QP is then moved to cpu by a
+            #   single async copy for the TRS kernels.
+            QcG = to_host(torch.vstack([Q.to(c.device), c, G]))
+            self.Q = QcG[:dim]
+            self.c = QcG[dim]
+            self.G = QcG[dim + 1 :]
+            self.ghg = (self.Q[0, 0] + self.ghg * self.iter) / (self.iter + 1)
 
     @drsom_timer
-    def normalize(self, direction):
-        v_norm = torch.sqrt(
-            sum(torch.linalg.norm(v) ** 2 for p, v in direction.items())
-        )
-        v_norm = 1 if v_norm == 0 else v_norm
-        return {p: v / v_norm for p, v in direction.items()}
-
-    def gather_normalized_grad(self, bool_normalized=False, alpha=1):
-        if bool_normalized:
-            return self.normalize(
-                {p: alpha * p.grad.detach().clone() for p in self._params}
+    def normalize(self, flat_dirs, g_norm=None):
+        """
+        normalize each row (direction) of flat_dirs in-place,
+          a zero direction is left as it is
+        Args:
+          g_norm: the norm of the first row if already known (-g)
+        Returns:
+          the (dim x 1) scales the rows are divided by
+        """
+        if g_norm is None:
+            v_norm = torch.linalg.norm(flat_dirs, dim=1, keepdim=True)
+        else:
+            v_norm = torch.cat(
+                [
+                    g_norm.reshape(1, 1),
+                    torch.linalg.norm(flat_dirs[1:], dim=1, keepdim=True),
+                ]
             )
-        return {p: alpha * p.grad.detach().clone() for p in self._params}
+        v_norm = torch.where(v_norm == 0, torch.ones_like(v_norm), v_norm)
+        flat_dirs.div_(v_norm)
+        return v_norm
 
-    def gather_normalize(self, k, bool_normalized=False):
-        if bool_normalized:
-            return self.normalize({p: self.state[p][k] for p in self._params})
-        return {p: self.state[p][k] for p in self._params}
+    @torch.no_grad()
+    def gather_directions(self):
+        """
+        fill the direction buffer self._D,
+          -g is the first direction, then the momentum (or the fixed momentum)
+        Returns:
+          the directions, each is a list of views aligned with self._params
+        """
+        grads = self._grads()
+        if self.fixed_momentum < 0:
+            # the gradient is copied (and negated) only once, into self._D
+            foreach_copy_(self._D_views[0], grads)
+            self._D[0].neg_()
+            for v, k in zip(self._D_views[1:], self.directions):
+                foreach_copy_(v, self._state_lists[k])
+            if self.bool_normalize:
+                self._g_scale = self.normalize(self._D, g_norm=self._g_norm)[0]
+        else:
+            foreach_copy_(self._g_views, grads)
+            foreach_copy_(
+                self._D_views[0], self.use_fixed_momentum(self.fixed_momentum)
+            )
+        return self._D_views
 
     def step(self, closure=None):
         """
@@ -448,36 +644,33 @@ class DRSOMB(torch.optim.Optimizer):
 
         if closure is None:
             raise ValueError("must provide a closure for DRSOM")
+        if self.compile_closure:
+            # the compiled code is cached by dynamo (keyed by the code object),
+            #   so wrapping a new closure at every step does not recompile;
+            #   functools.wraps keeps its attributes, e.g., `functional`
+            closure = torch.compile(closure, dynamic=False)
         closure = torch.enable_grad()(closure)
-        if DRSOM_VERBOSE:
-            torch.autograd.set_detect_anomaly(True)
 
         #
         self.decayrule.adjust_gamma_and_radius(self)
 
         loss = closure()
+        if self._bool_grad_vanish():
+            # a stationary point, no direction to search
+            self.iter += 1
+            return loss
 
         # copy of it at last step
         p_copy = self._clone_param()
 
         # @note
-        # no need to scale (even for gradient) since it is a new tensor.
-        g_old = self.gather_normalized_grad(
-            alpha=-1, bool_normalized=self.bool_normalize
-        )
-        if self.fixed_momentum < 0:
-            directions = [
-                g_old,  # make sure -g is the first direction
-                *(
-                    self.gather_normalize(k, bool_normalized=self.bool_normalize)
-                    for k in self.directions
-                ),
-            ]
-        else:
-            directions = [self.use_fixed_momentum(self.fixed_momentum)]
-        self.update_trust_region(
-            p_copy, directions, fx=loss.cpu().detach(), closure=closure,
-        )
+        # the directions are copied into the persistent buffer,
+        #   so they can be scaled without touching the gradient or the momentum.
+        directions = self.gather_directions()
+        # the loss is used as a python float from now on,
+        #   so the scalar bookkeeping below does not dispatch tensor ops
+        fx = loss.item()
+        self.update_trust_region(p_copy, directions, fx=fx, closure=closure)
         # accept or not?
         acc_step = False
         # adjust lambda: (and thus trust region radius)
@@ -485,30 +678,26 @@ class DRSOMB(torch.optim.Optimizer):
         with torch.no_grad():
             while iter_adj < self._max_iter_adj:
                 # solve alpha
-                trs_est = self.compute_step()
+                trs_est = self.compute_step().item()
                 if trs_est < 0:
                     self.gamma = max(self.gamma * self.adjrule.beta1, 1e-4)
                     self.radius = max(self.radius / np.sqrt(self.adjrule.beta1), 1e-12)
                     if DRSOM_VERBOSE:
-                        pprint(self.logline)
+                        print(format_logline(self.logline))
                     continue
                 alpha = self.alpha
 
-                # build direction
-                dim = len(directions)
-                d_new = {
-                    p: torch.zeros_like(p, requires_grad=False) for p in self._params
-                }
-                for p in self._params:
-                    for i in range(dim):
-                        u = directions[i][p]
-                        d_new[p].add_(u, alpha=alpha[i])
+                # build direction, d_new = alpha' D by a single GEMV
+                d_new = self._d_new
+                torch.mv(self._D.T, alpha.to(self._D), out=self._d_new_flat)
 
                 self._use_new_d(d_new)
-                loss_est = closure(backward=False).detach().cpu()
+                loss_est = closure(backward=False).item()
                 # accept or not？
-                loss_dec = loss - loss_est
-                rho = loss_dec / trs_est
+                loss_dec = fx - loss_est
+                # (inf or nan if the model predicts no decrease, as in torch)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    rho = np.float64(loss_dec) / trs_est
 
                 # update the trust-region radius (implicitly by gamma/lambda)
                 lmb_dec = 0
@@ -542,23 +731,17 @@ class DRSOMB(torch.optim.Optimizer):
 
                 acc_step = rho > self.adjrule.eta
                 if DRSOM_VERBOSE:
-                    self.logline["dQ"] = "{:+.2e}".format(trs_est.item())
-                    self.logline["df"] = "{:+.2e}".format(loss_dec.item())
-                    self.logline["rho"] = "{:+.2e}".format(rho.item())
-                    self.logline["acc"] = int(acc_step.item())
+                    self.logline["dQ"] = "{:+.2e}".format(trs_est)
+                    self.logline["df"] = "{:+.2e}".format(loss_dec)
+                    self.logline["rho"] = "{:+.2e}".format(rho)
+                    self.logline["acc"] = int(acc_step)
                     self.logline["acc-𝜆"] = lmb_dec
                     self.logline["𝛄"] = "{:+.2e}".format(self.gamma)
                     self.logline["𝛄-"] = "{:+.2e}".format(gamma_old)
-                    self.logline["f"] = "{:+.2e}".format(loss.item())
+                    self.logline["f"] = "{:+.2e}".format(fx)
                     self.logline["k"] = "{:+6d}".format(self.iter)
                     self.logline["k0"] = iter_adj
-                    print(
-                        pd.DataFrame(
-                            data=[list(self.logline.values())],
-                            columns=self.logline.keys(),
-                            dtype=str,
-                        ).to_markdown(tablefmt="grid")
-                    )
+                    print(format_logline(self.logline))
                 if not acc_step:
                     # set back to old ~ trial step failed
                     self._set_param(p_copy)
@@ -10,8 +10,30 @@ import torch
 import numpy as np
 from enum import IntEnum
 
+from . import trs_numba
+
 os.environ["KMP_DUPLICATE_LIB_OK"] = "True"
 DRSOM_VERBOSE = int(os.environ.get("DRSOM_VERBOSE", 0))
+# compare the interpolated Q with the HVP one every N steps (0: never),
+#   it costs an extra backward pass, so it is separated from DRSOM_VERBOSE
+DRSOM_DEBUG_Q_CHECK = int(os.environ.get("DRSOM_DEBUG_Q_CHECK", 0))
+# compile the small fixed-shape kernels by torch.compile (needs torch>=2.0)
+DRSOM_COMPILE = int(os.environ.get("DRSOM_COMPILE", 0))
+# anomaly detection of autograd, it slows down every backward op,
+#   so it is not enabled by DRSOM_VERBOSE
+DRSOM_DETECT_ANOMALY = int(os.environ.get("DRSOM_DETECT_ANOMALY", 0))
+# the options of the flat DRSOM (drsom_vec.py) and HSODM, as set by run.*.sh
+#   - DRSOM_MODE: the directions, see DRSOMMode
+#   - DRSOM_MODE_QP: Q by 0: hvp, 1: interpolation
+#   - DRSOM_MODE_HVP: hvp by 0: AD, 1: FD
+#   - DRSOM_MODE_DECAY: the decay rule of gamma and the radius (-1: no decay)
+#   - DRSOM_MODE_DELTA: the interpolation stepsize rule
+DRSOM_MODE = int(os.environ.get("DRSOM_MODE", 0))
+DRSOM_MODE_QP = int(os.environ.get("DRSOM_MODE_QP", 0))
+DRSOM_MODE_HVP = int(os.environ.get("DRSOM_MODE_HVP", 0))
+DRSOM_MODE_DECAY = int(os.environ.get("DRSOM_MODE_DECAY", -1))
+DRSOM_MODE_DELTA = int(os.environ.get("DRSOM_MODE_DELTA", 0))
+DRSOM_NORMALIZE = int(os.environ.get("DRSOM_NORMALIZE", 0))
 
 DRSOM_GLOBAL_PROFILE = {
     "count": collections.defaultdict(int),
@@ -26,6 +48,26 @@ def update_running_stat(aa, m_aa, stat_decay):
     m_aa *= 1 - stat_decay
 
 
+def foreach_copy_(tensors, srcs):
+    # fused copy (a single launch over the tensor list) if available
+    if hasattr(torch, "_foreach_copy_"):
+        torch._foreach_copy_(tensors, srcs)
+    else:
+        for t, src in zip(tensors, srcs):
+            t.copy_(src)
+
+
+def to_host(tensor):
+    # a non-blocking copy into pinned memory and a single synchronize,
+    #   instead of one blocking transfer per entry
+    if not tensor.is_cuda:
+        return tensor
+    buf = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+    buf.copy_(tensor, non_blocking=True)
+    torch.cuda.current_stream(tensor.device).synchronize()
+    return buf
+
+
 def load_checkpoint(ckpt_name):
     print("==> Resuming from checkpoint..")
     assert os.path.isdir("checkpoint"), "Error: no checkpoint directory found!"
@@ -57,9 +99,64 @@ def drsom_timer(func):
     return wrapper
 
 
+def format_logline(logline):
+    # a single "key=value | ..." line, cheap enough for every trial step
+    return " | ".join(f"{k}={v}" for k, v in logline.items())
+
+
+def drsom_compile(func=None, **kwargs):
+    """
+    torch.compile `func` (with kwargs) if DRSOM_COMPILE is set,
+      otherwise (or if torch.compile is unavailable) return it untouched.
+    """
+    if func is None:
+        return functools.partial(drsom_compile, **kwargs)
+    if DRSOM_COMPILE and hasattr(torch, "compile"):
+        return torch.compile(func, **kwargs)
+    return func
+
+
+@drsom_compile(dynamic=False)
+def fused_inner(D, g):
+    """
+    the inner products G = D D' and c = D g,
+      where D (dim x n) holds the flattened directions.
+    Args:
+      D: the (dim x n) direction matrix
+      g: the flattened gradient
+
+    Returns:
+      G, c
+    """
+    return D @ D.T, D @ g
+
+
+@drsom_compile(fullgraph=True, dynamic=False)
+def trial_point_(d, x_new, D, alpha, x):
+    """
+    the trial step d = D' alpha and the trial point x_new = x + d,
+      written into the (persistent) buffers d and x_new.
+    Args:
+      D: the (dim x n) direction matrix
+      alpha: the step sizes of the directions
+      x: the flattened parameters
+    """
+    torch.mv(D.T, alpha, out=d)
+    torch.add(x, d, out=x_new)
+
+
 ##########################################
 # TRS/Regularized QP solver
 ##########################################
+@drsom_compile(fullgraph=True, dynamic=False)
+def trs_estimate(Q, c, alpha):
+    """
+    the decrease predicted by the quadratic model at alpha,
+      -(1/2 alpha'Q alpha + c'alpha)
+    """
+    return -1 / 2 * (Q @ alpha).dot(alpha) - c.dot(alpha)
+
+
 class TRS:
     eigvalsh = scipy.linalg.eigvalsh
     # lsolve = torch.linalg.solve
@@ -71,6 +168,16 @@ class TRS:
     def _norm(alpha, G):
         return (G @ alpha).dot(alpha).sqrt().item()
 
+    @staticmethod
+    def _bool_small(c, G):
+        # the 2 or 3-dimensional case with a nonsingular G has a compiled kernel,
+        #   a zero direction (any zero diagonal entry of G) takes the fallback
+        return len(c) in {2, 3} and bool((G.diagonal() != 0).all())
+
+    @staticmethod
+    def _as_numpy(*args):
+        return [v.detach().cpu().double().numpy() for v in args]
+
     @staticmethod
     def _compute_root(Q, c, gamma, G):
         """
@@ -80,6 +187,11 @@ class TRS:
           gamma: is the scale param
         """
 
+        if TRS._bool_small(c, G):
+            Qn, cn, Gn = TRS._as_numpy(Q, c, G)
+            _lmb_this, alpha, norm = trs_numba.compute_root(Qn, cn, gamma, Gn)
+            return 0, _lmb_this, torch.from_numpy(alpha).to(c.dtype), float(norm), True
+
         if len(c) == 1 or G[1, 1] == 0:
             lmin = max(0, (-Q[0, 0] / G[0, 0]).item())
         else:
@@ -104,6 +216,11 @@ class TRS:
     def _compute_root_tr(Q, c, delta, G=torch.eye(2)):
         eps = 1e-2
 
+        if TRS._bool_small(c, G):
+            Qn, cn, Gn = TRS._as_numpy(Q, c, G)
+            it, _lmb_this, alpha, norm = trs_numba.compute_root_tr(Qn, cn, delta, Gn)
+            return it, _lmb_this, torch.from_numpy(alpha).to(c.dtype), float(norm), True
+
         if len(c) == 1 or G[1, 1] == 0:
             lmin = max(0, (-Q[0, 0] / G[0, 0]).item())
         else:
@@ -351,6 +468,9 @@ class DRSOMMode(IntEnum):
         return directions
 
 
+DRSOM_DIRECTIONS = DRSOMMode(DRSOM_MODE).get_directions()
+
+
 class DRSOMModeDecay(IntEnum):
     """
     rules to decay gamma and radius
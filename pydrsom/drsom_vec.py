@@ -7,11 +7,9 @@ the original dimension-reduced second-order method (DRSOM) in radius free mode
   - we treat the parameters as one "d x 1" flat vector.
 """
 from functools import reduce
-from pprint import pprint
 from typing import Optional
 import torch
 import numpy as np
-import pandas as pd
 
 from torch.nn.utils import parameters_to_vector
 
@@ -24,6 +22,7 @@ class DRSOM(torch.optim.Optimizer):
         params,
         max_iter=15,
         option_tr="p",
+        qpsolver: Optional[DRSOMQPSolver] = DRSOMQPSolver(0),
         gamma=1e-6,
         beta1=5e1,
         beta2=3e1,
@@ -40,6 +39,7 @@ class DRSOM(torch.optim.Optimizer):
       option_tr: option of trust-region, I or G?
                - if 'a'; G = eye(2)
                - if 'p'; G = [-g d]'[-g d]
+      qpsolver: the rule to solve the QP, see DRSOMQPSolver
       gamma: lower bound for gamma
       beta1: gamma + multiplier
       beta2: gamma - multiplier
@@ -50,18 +50,39 @@ class DRSOM(torch.optim.Optimizer):
         __unused = kwargs
         defaults = dict(betas=thetas, eps=eps)
         super(DRSOM, self).__init__(params, defaults)
+        if DRSOM_DETECT_ANOMALY:
+            # set once (a global switch), it slows down every backward op
+            torch.autograd.set_detect_anomaly(True)
         ##########################
         # AD hvps
         ##########################
-        self.Hv = None
         self._params = self.get_params()
-        for p in self._params:
-            # keep momentum
-            for k in DRSOM_DIRECTIONS:
-                self.state[p][k] = torch.zeros_like(p.data, requires_grad=True)
 
         #
         self._numel_cache = None
+        # persistent flat buffers of the parameters (the copy at the last step),
+        #   the trial step and the trial point, with views aligned with self._params
+        self._flat_p = parameters_to_vector(self._params).detach()
+        self._p_views = self._as_views(self._flat_p)
+        self._flat_new_d = torch.zeros_like(self._flat_p)
+        self._flat_new_p = torch.zeros_like(self._flat_p)
+        # the (dim x n) Hessian-vector products, one row per direction
+        dim = 1 + len(DRSOM_DIRECTIONS)
+        self.Hv = self._flat_p.new_empty((dim, self._flat_p.numel()))
+        # the (dim x n) direction matrix, g first, then the momentum
+        self._V = torch.zeros_like(self.Hv)
+        # identity of the subspace, on the device (batched HVP seeds)
+        #   and on the host (G of option_tr 'a')
+        self._eye = torch.eye(dim, dtype=self._flat_p.dtype, device=self._flat_p.device)
+        self._eye_host = torch.eye(dim, dtype=self._flat_p.dtype)
+        # keep momentum, one flat buffer per direction;
+        #   the states are views into it, so it is never gathered
+        #   (a plain buffer, no gradient is ever taken w.r.t. it)
+        self._flat_m = {k: torch.zeros_like(self._flat_p) for k in DRSOM_DIRECTIONS}
+        self._alias_momentum()
+        # if the momentum is all zero (at first, or after a restart),
+        #   only g needs a Hessian-vector product
+        self._bool_momentum_zero = True
         ##########################
         # DRSOM only params
         ##########################
@@ -69,6 +90,7 @@ class DRSOM(torch.optim.Optimizer):
         self.freq = 1
         self._max_iter_adj = max_iter
         self.option_tr = option_tr
+        self.qpsolver = qpsolver
 
         ##########################
         # global averages & keepers
@@ -92,6 +114,7 @@ class DRSOM(torch.optim.Optimizer):
         self.beta2 = beta2
         # maximum step size
         self.delta_max = 1e1
+        self.radius = 1e1
         ##########################
         # step acc rules
         ##########################
@@ -130,60 +153,83 @@ class DRSOM(torch.optim.Optimizer):
     def _bool_grad_vanish(self, p):
         return p.grad is None or torch.linalg.norm(p.grad) < 1e-8
 
+    def __setstate__(self, state):
+        super(DRSOM, self).__setstate__(state)
+        if hasattr(self, "_flat_m"):
+            # e.g., by load_state_dict, the states are new tensors
+            self._alias_momentum()
+            self._bool_momentum_zero = False
+
+    @torch.no_grad()
+    def _alias_momentum(self):
+        # make the momentum states views into the flat buffers (keeping their values)
+        for k, flat in self._flat_m.items():
+            for p, v in zip(self._params, self._as_views(flat)):
+                if k in self.state[p]:
+                    v.copy_(self.state[p][k])
+                self.state[p][k] = v
+
     @torch.no_grad()
     def _clear_momentum(self):
         # only has globally state
-        for p in self._params:
-            for k in DRSOM_DIRECTIONS:
-                if k in self.state[p]:
-                    self.state[p][k].zero_()
+        for flat in self._flat_m.values():
+            flat.zero_()
+        self._bool_momentum_zero = True
+
+    def _as_views(self, flat):
+        """
+    split a flat vector into views aligned with self._params
+    """
+        return [
+            v.view_as(p)
+            for v, p in zip(
+                torch.split(flat, [p.numel() for p in self._params]), self._params
+            )
+        ]
 
     @drsom_timer
     def _apply_step(self, flat_p):
         with torch.no_grad():
-            offset = 0
-            for p in self._params:
-                numel = p.numel()
-                # view as to avoid deprecated pointwise semantics
-                p.copy_(flat_p[offset : offset + numel].view_as(p))
-                offset += numel
-            assert offset == self._numel()
+            foreach_copy_(self._params, self._as_views(flat_p))
 
     @drsom_timer
-    def _save_momentum(self, *args):
+    def _save_momentum(self, d=None, dg=None):
         """
     saving momentum
     Args:
-      *args:
-      0 - d(x)
-      1 - d(g)
+      d: d(x)
+      dg: d(g)
+      (skipped if None)
     Returns:
 
     """
         with torch.no_grad():
-
-            offset = 0
-            for p in self._params:
-                numel = p.numel()
-                # view as to avoid deprecated pointwise semantics
-                if "momentum" in DRSOM_DIRECTIONS:
-                    self.state[p]["momentum"].copy_(
-                        args[0][offset : offset + numel].view_as(p)
-                    )
-                if "momentum_g" in DRSOM_DIRECTIONS:
-                    self.state[p]["momentum_g"].copy_(
-                        args[1][offset : offset + numel].view_as(p)
-                    )
-                offset += numel
-            assert offset == self._numel()
+            for k, v in (("momentum", d), ("momentum_g", dg)):
+                if k in DRSOM_DIRECTIONS and v is not None:
+                    self._flat_m[k].copy_(v)
+                    self._bool_momentum_zero = False
 
     @drsom_timer
     def _directional_evaluate(self, closure, flat_p):
         self._apply_step(flat_p)
-        # evaluation
-        loss = float(closure(backward=False))
+        # evaluation, the loss tensor (and its graph) is kept for momentum_g
+        loss = closure(backward=False)
         return loss
 
+    @drsom_timer
+    def _trial_grad(self, loss, closure):
+        """
+    the flat gradient at the accepted trial point on the same batch,
+      by a backward pass over the graph of its evaluation;
+      the closure is called again only if it evaluated without a graph
+    """
+        if loss.requires_grad:
+            grads = torch.autograd.grad(loss, self._params)
+        else:
+            closure()
+            grads = [p.grad for p in self._params]
+        return parameters_to_vector(grads)
+
     def _numel(self):
         if self._numel_cache is None:
             self._numel_cache = reduce(
@@ -195,14 +241,9 @@ class DRSOM(torch.optim.Optimizer):
     def _gather_flat_grad(self, _valid_params, target="self"):
         if target == "grad":
             flat = torch.concat([p.grad.reshape(-1) for p in _valid_params])
-        elif target == "momentum":
-            flat = torch.concat(
-                [self.state[p]["momentum"].reshape(-1) for p in _valid_params]
-            )
-        elif target == "momentum_g":
-            flat = torch.concat(
-                [self.state[p]["momentum_g"].reshape(-1) for p in _valid_params]
-            )
+        elif target in {"momentum", "momentum_g"}:
+            # already flat (the states are views into it)
+            flat = self._flat_m[target]
         else:
             flat = torch.concat([p.reshape(-1) for p in _valid_params])
 
@@ -218,7 +259,7 @@ class DRSOM(torch.optim.Optimizer):
         # compute alpha
         if option_tr == "a":
             self.alpha, self.alpha_norm = self.solve_alpha(
-                self.Q, self.c, tr=torch.eye(len(self.c))
+                self.Q, self.c, tr=self._eye_host
             )
         elif option_tr == "p":
             self.alpha, self.alpha_norm = self.solve_alpha(self.Q, self.c, tr=self.G)
@@ -228,36 +269,37 @@ class DRSOM(torch.optim.Optimizer):
         ####################################
         # compute estimate decrease
         ####################################
-        trs_est = -1 / 2 * (self.Q @ self.alpha).dot(self.alpha) - self.c.dot(
-            self.alpha
+        # the subproblem lives on the host,
+        #   plain numpy (float64) avoids a torch dispatch per 2 x 2 op
+        Q, c, alpha = (
+            np.asarray(v, dtype=np.float64) for v in (self.Q, self.c, self.alpha)
         )
+        trs_est = -1 / 2 * (Q @ alpha) @ alpha - c @ alpha
 
         return trs_est
 
     @drsom_timer
-    def hv(self, g, v, flag=0, index=0):
+    def hv(self, g, V):
         """
-    exact metric
+    exact metric,
+      the Hessian-vector products of all directions
+      are evaluated by a single (batched) backward pass.
     Args:
-      g:
-      v:
-      flag:
-      index:
+      g: the flat gradient (with its graph)
+      V: the (dim x n) direction matrix
 
     Returns:
-
+      the (dim x n) matrix of H @ V[i]
     """
-        mul = 0.5 if flag == 1 else 1
-        gv = g.dot(v)
-        self.Hv[index] = self._gather_flat_grad(
-            torch.autograd.grad(
-                gv * mul,
-                self._params,
-                # create_graph=True,
-                retain_graph=True,
-            ),
-            target="self",
+        dim = V.shape[0]
+        Hv = torch.autograd.grad(
+            V @ g,
+            self._params,
+            grad_outputs=self._eye[:dim, :dim],
+            is_grads_batched=True,
+            retain_graph=True,
         )
+        return torch.cat([hv.reshape(dim, -1) for hv in Hv], dim=1, out=self.Hv[:dim])
 
     @drsom_timer
     def hv_diff(self, flat_p, g, v, closure, flag=0, index=0, eps=1e-8):
@@ -278,24 +320,19 @@ class DRSOM(torch.optim.Optimizer):
             self._apply_step(eps * v + flat_p)
         _ = closure()
         g_eps = parameters_to_vector([p.grad for p in self._params])
-        self.Hv[index] = scale * (g_eps - g) * mul
+        self.Hv[index] = (scale * (g_eps - g) * mul).detach()
 
     @drsom_timer
     def update_trust_region(
-        self, flat_p, flat_g, directions, closure=None, style=DRSOM_MODE_HVP
+        self, flat_p, flat_g, V, closure=None, style=DRSOM_MODE_HVP
     ):
 
         with torch.enable_grad():
             __unused = flat_p
 
-            dim = len(directions)
-            # construct G (the inner products)
-            G = torch.zeros((dim, dim), requires_grad=False, device="cpu")
-            for i, v in enumerate(directions):
-                for j in range(i, dim):
-                    u = directions[j]
-                    # compute G[i,j]
-                    G[i, j] = G[j, i] = v.dot(u).detach().cpu()
+            # construct G (the inner products) and c by GEMMs,
+            #   kept on the device until Q is ready
+            G, c = fused_inner(V, flat_g.detach())
 
             # compute Hv for v in directions;
             #   assume directions[0] = g/|g|
@@ -308,22 +345,27 @@ class DRSOM(torch.optim.Optimizer):
                 # @note:
                 #   compute Hv:
                 #   by analytic gv
-                Q = torch.zeros((dim, dim), requires_grad=False, device="cpu")
-                if self.Hv is None:
-                    self.Hv = [torch.empty_like(flat_g) for _ in directions]
-                for i, v in enumerate(directions):
-                    if style == 0:
-                        self.hv(flat_g, v, index=i)
-                    elif style == 1:
+                if style == 0 and self._bool_momentum_zero:
+                    # rank-1: the other rows of V (and so of Hv) are zero
+                    self.hv(flat_g, V[:1])
+                    self.Hv[1:].zero_()
+                    Hv = self.Hv
+                elif style == 0:
+                    Hv = self.hv(flat_g, V)
+                elif style == 1:
+                    for i, v in enumerate(V):
                         self.hv_diff(flat_p, flat_g, v, closure, index=i)
-                for i, v in enumerate(directions):
-                    for j in range(i, dim):
-                        Q[i, j] = Q[j, i] = v.dot(self.Hv[j]).detach().cpu()
-
-                c = torch.tensor(
-                    [flat_g.dot(v).detach().cpu() for v in directions],
-                    requires_grad=False,
-                )
+                    Hv = self.Hv
+                else:
+                    raise ValueError("not implemented,")
+                # a single GEMM, symmetrized
+                Q = V @ Hv.T
+                Q = (Q + Q.T) / 2
+
+                # a single transfer to the host
+                dim = V.shape[0]
+                QcG = to_host(torch.vstack([Q, c, G]).detach())
+                Q, c, G = QcG[:dim], QcG[dim], QcG[dim + 1 :]
                 self.ghg = (Q[0, 0] + self.ghg * self.iter) / (self.iter + 1)
 
                 # compute Q/c/G
@@ -332,15 +374,22 @@ class DRSOM(torch.optim.Optimizer):
                 # use generalized a'Ga <= delta
                 self.G = G
 
-    def normalize(self, v):
-        v_norm = torch.linalg.norm(v)
-        v_norm = 1 if v_norm == 0 else v_norm
-        return v / v_norm
+    def normalize(self, V):
+        # normalize each row in-place, a zero row is left as it is
+        v_norm = torch.linalg.norm(V, dim=1, keepdim=True)
+        v_norm = torch.where(v_norm == 0, torch.ones_like(v_norm), v_norm)
+        return V.div_(v_norm)
 
-    def gather_normalize(self, k):
-        return self.normalize(
-            self._gather_flat_grad([self.state[p][k] for p in self._params])
-        )
+    @torch.no_grad()
+    def gather_normalize(self, flat_g):
+        """
+    fill the direction matrix self._V by g and the momentum,
+      then normalize all rows at once
+    """
+        self._V[0].copy_(flat_g)
+        for v, k in zip(self._V[1:], DRSOM_DIRECTIONS):
+            v.copy_(self._gather_flat_grad(self._params, target=k))
+        return self.normalize(self._V)
 
     def step(self, closure=None):
         """
@@ -352,58 +401,53 @@ class DRSOM(torch.optim.Optimizer):
         if closure is None:
             raise ValueError("must provide a closure for RSOM")
         closure = torch.enable_grad()(closure)
-        if DRSOM_VERBOSE:
-            torch.autograd.set_detect_anomaly(True)
         n_iter = 0
 
         loss = closure()
-        flat_p = parameters_to_vector(self._params)
-        # copy of it at last step
-        p_copy = self._clone_param()
+        # copy of the parameters at last step (into the persistent flat buffer)
+        with torch.no_grad():
+            foreach_copy_(self._p_views, self._params)
+        flat_p = self._flat_p
 
         flat_g = parameters_to_vector([p.grad for p in self._params])
 
         # @note
-        # no need to scale (even for gradient) since it is a new tensor.
-        directions = [
-            self.normalize(flat_g),  # make sure g is the first direction
-            *(self.gather_normalize(k) for k in DRSOM_DIRECTIONS),
-        ]
+        # the directions are copied into self._V before scaling,
+        #   make sure g is the first direction
+        V = self.gather_normalize(flat_g)
 
         self.update_trust_region(
-            flat_p, flat_g, directions, closure=closure, style=DRSOM_MODE_HVP
+            flat_p, flat_g, V, closure=closure, style=DRSOM_MODE_HVP
         )
         # accept or not?
         acc_step = False
         # adjust lambda: (and thus trust region radius)
         iter_adj = 1
+        # the loss as a python float for the scalar bookkeeping below
+        fx = loss.item()
         while iter_adj < self._max_iter_adj:
             # solve alpha
             trs_est = self.compute_step(option_tr=self.option_tr)
             if trs_est < 0:
                 self.gamma = max(self.gamma * self.beta1, 1e-4)
                 if DRSOM_VERBOSE:
-                    pprint(self.logline)
+                    print(format_logline(self.logline))
                 continue
             alpha = self.alpha
 
-            # build direction
-
-            flat_new_d = torch.zeros_like(flat_p, requires_grad=False)
-            for aa, dd in zip(alpha, directions):
-                flat_new_d.add_(dd, alpha=aa)
-
-            # new trial points
-            flat_new_p = (
-                torch.zeros_like(flat_p, requires_grad=False)
-                .copy_(flat_p)
-                .add_(flat_new_d)
-            )
+            with torch.no_grad():
+                # build direction, d_new = alpha' V by a single GEMV,
+                #   and the new trial point
+                flat_new_d, flat_new_p = self._flat_new_d, self._flat_new_p
+                trial_point_(flat_new_d, flat_new_p, V, alpha.to(V), flat_p)
 
             # accept or not？
-            loss_est = self._directional_evaluate(closure, flat_new_p)
-            loss_dec = loss - loss_est
-            rho = loss_dec / trs_est
+            trial_loss = self._directional_evaluate(closure, flat_new_p)
+            loss_est = trial_loss.item()
+            loss_dec = fx - loss_est
+            # (inf or nan if the model predicts no decrease, as in torch)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                rho = np.float64(loss_dec) / trs_est
 
             # update the trust-region radius (implicitly by gamma/lambda)
             lmb_dec = 0
@@ -419,35 +463,32 @@ class DRSOM(torch.optim.Optimizer):
 
             acc_step = rho > self.eta
             if DRSOM_VERBOSE:
-                self.logline["dQ"] = "{:+.2e}".format(trs_est.item())
-                self.logline["df"] = "{:+.2e}".format(loss_dec.item())
-                self.logline["rho"] = "{:+.2e}".format(rho.item())
-                self.logline["acc"] = int(acc_step.item())
+                self.logline["dQ"] = "{:+.2e}".format(trs_est)
+                self.logline["df"] = "{:+.2e}".format(loss_dec)
+                self.logline["rho"] = "{:+.2e}".format(rho)
+                self.logline["acc"] = int(acc_step)
                 self.logline["acc-𝜆"] = lmb_dec
                 self.logline["𝛄"] = "{:+.2e}".format(self.gamma)
                 self.logline["𝛄-"] = "{:+.2e}".format(gamma_old)
-                self.logline["f"] = "{:+.2e}".format(loss.item())
+                self.logline["f"] = "{:+.2e}".format(fx)
                 self.logline["k"] = "{:+6d}".format(self.iter)
                 self.logline["k0"] = iter_adj
-                print(
-                    pd.DataFrame(
-                        data=[list(self.logline.values())],
-                        columns=self.logline.keys(),
-                        dtype=str,
-                    ).to_markdown(tablefmt="grid")
-                )
+                print(format_logline(self.logline))
             if not acc_step:
                 # set back to old ~ trial step failed
-                self._set_param(p_copy)
+                self._set_param(self._p_views)
+                # free the graph of the rejected trial
+                trial_loss = None
 
             else:
                 if "momentum_g" in DRSOM_DIRECTIONS:
-                    # compute flat_momentum_g
-                    _loss = closure()
-                    flat_g_new = parameters_to_vector([p.grad for p in self._params])
-                    self._save_momentum(flat_new_d, flat_g_new - flat_g)
+                    # compute flat_momentum_g,
+                    #   the gradient difference on the same batch,
+                    #   without another forward pass
+                    flat_g_new = self._trial_grad(trial_loss, closure)
+                    self._save_momentum(d=flat_new_d, dg=flat_g_new - flat_g)
                 else:
-                    self._save_momentum(flat_new_d)
+                    self._save_momentum(d=flat_new_d)
                 break
 
             iter_adj += 1
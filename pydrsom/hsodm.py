@@ -6,10 +6,8 @@ the original dimension-reduced second-order method (DRSOM) in radius free mode
   - the options to run DRSOM can be controlled by the environment variables, see `drsom_utils.py`
   - we treat the parameters as a set of tensors (no flatten() anymore)
 """
-from pprint import pprint
 from typing import Optional
 
-import pandas as pd
 
 from .drsom_utils import *
 from .drsom_utils import DRSOMDecayRules
@@ -20,6 +18,8 @@ class HSODM(torch.optim.Optimizer):
         self,
         params,
         max_iter=15,
+        option_tr="p",
+        qpsolver: Optional[DRSOMQPSolver] = DRSOMQPSolver(0),
         adjrules: Optional[DRSOMAdjustRules] = DRSOMAdjustRules(),
         decayrules: Optional[DRSOMDecayRules] = DRSOMDecayRules(),
         thetas=(0.99, 0.999),
@@ -35,6 +35,7 @@ class HSODM(torch.optim.Optimizer):
       option_tr: option of trust-region, I or G?
                - if 'a'; G = eye(2)
                - if 'p'; G = [-g d]'[-g d]
+      qpsolver: the rule to solve the QP, see DRSOMQPSolver
       gamma: lower bound for gamma
       beta1: gamma + multiplier
       beta2: gamma - multiplier
@@ -46,15 +47,23 @@ class HSODM(torch.optim.Optimizer):
         defaults = dict(betas=thetas, eps=eps)
         # params = model.parameters()
         super(HSODM, self).__init__(params, defaults)
+        if DRSOM_DETECT_ANOMALY:
+            # set once (a global switch), it slows down every backward op
+            torch.autograd.set_detect_anomaly(True)
         ##########################
         # AD hvps
         ##########################
-        self.Hv = None
         self._params = self.get_params()
         for p in self._params:
             # keep momentum
+            #   (a plain buffer, no gradient is ever taken w.r.t. it)
             for k in DRSOM_DIRECTIONS:
-                self.state[p][k] = torch.zeros_like(p.data, requires_grad=True)
+                self.state[p][k] = torch.zeros_like(p.data)
+        # identity of the subspace (batched HVP seeds, G of option_tr 'a')
+        p0 = self._params[0]
+        self._eye = torch.eye(
+            1 + len(DRSOM_DIRECTIONS), dtype=p0.dtype, device=p0.device
+        )
 
         #
         self._numel_cache = None
@@ -62,6 +71,8 @@ class HSODM(torch.optim.Optimizer):
         # DRSOM only params
         ##########################
         self._max_iter_adj = max_iter
+        self.option_tr = option_tr
+        self.qpsolver = qpsolver
 
         ##########################
         # global averages & keepers
@@ -128,8 +139,8 @@ class HSODM(torch.optim.Optimizer):
 
     @torch.no_grad()
     def _use_new_d(self, d_new):
-        for p in self._params:
-            p.add_(d_new[p])
+        for p, d in zip(self._params, d_new):
+            p.add_(d)
 
     def _bool_grad_vanish(self, p):
         return p.grad is None or torch.linalg.norm(p.grad) < 1e-8
@@ -149,9 +160,8 @@ class HSODM(torch.optim.Optimizer):
     """
         with torch.no_grad():
             for idx, p in enumerate(self._params):
-                # self.state[p][key] = vlist[p]
                 update_running_stat(
-                    vlist[p], self.state[p][key], self.decayrule.qp_rate
+                    vlist[idx], self.state[p][key], self.decayrule.qp_rate
                 )
 
     @torch.no_grad()
@@ -175,47 +185,45 @@ class HSODM(torch.optim.Optimizer):
         return trs_est
 
     @drsom_timer
-    def hv(self, directions):
+    def hv(self, flat_dirs):
         """
-    exact metric
+    exact metric,
+      the Hessian-vector products of all directions
+      are evaluated by a single (batched) backward pass.
     Args:
-      p:
-      v:
+      flat_dirs: the (dim x n) direction matrix
 
     Returns:
-
+      the (dim x n) matrix of the flattened H @ directions[i]
     """
-
-        gv = [torch.mul(p.grad, directions[p]).sum() for p in self._params]
-        return torch.autograd.grad(
-            gv, self._params, create_graph=True, retain_graph=True
+        dim = flat_dirs.shape[0]
+        gv = flat_dirs @ torch.cat([p.grad.reshape(-1) for p in self._params])
+        Hv = torch.autograd.grad(
+            gv,
+            self._params,
+            grad_outputs=self._eye[:dim, :dim],
+            is_grads_batched=True,
+            retain_graph=True,
         )
+        return torch.cat([hv.detach().reshape(dim, -1) for hv in Hv], dim=1)
+
+    def _flatten(self, directions):
+        # the (dim x n) direction matrix
+        return torch.stack([torch.cat([u.reshape(-1) for u in v]) for v in directions])
 
     @drsom_timer
-    def compute_Q_via_hvp(self, directions, style):
-        dim = len(directions)
-        Q = torch.zeros((dim, dim), requires_grad=False, device="cpu")
-        if self.Hv is None:
-            self.Hv = [[] for _ in range(dim)]
-        for i in range(dim):
-            if style == 0:
-                self.Hv[i] = self.hv(directions[i])
-            elif style == 1:
-                raise ValueError(
-                    "the finite diff option is unused," " try DRSOM_MODE_HVP=0"
-                )
-            else:
-                raise ValueError("not implemented," " try DRSOM_MODE_HVP=0")
-        for i in range(dim):
-            for j in range(i, dim):
-                for idx, p in enumerate(self._params):
-                    u = directions[i][p]
-                    hv = self.Hv[j][idx]
-                    Q[i, j] += torch.mul(u, hv).sum().cpu().detach()
-        for i in range(dim):
-            for j in range(i):
-                Q[i, j] = Q[j, i]
-        return Q
+    def compute_Q_via_hvp(self, flat_dirs, style):
+        if style == 0:
+            flat_Hv = self.hv(flat_dirs)
+        elif style == 1:
+            raise ValueError(
+                "the finite diff option is unused," " try DRSOM_MODE_HVP=0"
+            )
+        else:
+            raise ValueError("not implemented," " try DRSOM_MODE_HVP=0")
+        # a single GEMM, symmetrized, kept on the device
+        Q = flat_dirs @ flat_Hv.T
+        return ((Q + Q.T) / 2).detach()
 
     @drsom_timer
     def build_natural_basis(self, v):
@@ -295,13 +303,13 @@ class HSODM(torch.optim.Optimizer):
         k = len(a)
         df = np.zeros((k, 1))
         K = np.array([self.build_natural_basis(v) for v in a])
-        d_new = {p: torch.zeros_like(p, requires_grad=False) for p in self._params}
+        d_new = [torch.zeros_like(p, requires_grad=False) for p in self._params]
         for j in range(k):
-            for p in self._params:
-                d_new[p].zero_()
+            for idx, p in enumerate(self._params):
+                d_new[idx].zero_()
                 for i in range(dim):
-                    u = directions[i][p]
-                    d_new[p].add_(u, alpha=a[j][i])
+                    u = directions[i][idx]
+                    d_new[idx].add_(u, alpha=a[j][i])
 
             self._use_new_d(d_new)
             loss_est = closure(backward=False).detach().cpu()
@@ -315,19 +323,18 @@ class HSODM(torch.optim.Optimizer):
         else:
             q, *_ = np.linalg.lstsq(K, df)
         q = q.flatten()
-        Q = torch.zeros((dim, dim), requires_grad=False, device="cpu")
-        for i in range(dim):
-            for j in range(i, dim):
-                Q[i, j] = q[int(j * (j + 1) / 2) + i]
-        for i in range(dim):
-            for j in range(0, i):
-                Q[i, j] = Q[j, i]
+        # q is ordered as the basis (np.triu_indices), fill both triangles at once
+        iu = np.triu_indices(dim)
+        Q = np.zeros((dim, dim))
+        Q[iu] = q
+        Q[iu[::-1]] = q
+        Q = torch.from_numpy(Q).to(c.dtype)
         del d_new
         if DRSOM_VERBOSE:
             ###########################################################
             # compare with HVP
             _ = closure(backward=True)
-            Q1 = self.compute_Q_via_hvp(directions, style=0)
+            Q1 = self.compute_Q_via_hvp(self._flatten(directions), style=0)
             q1 = Q1.triu().cpu().detach().numpy()
             q1 = q1[q1.nonzero()]
             print(q1)
@@ -342,32 +349,15 @@ class HSODM(torch.optim.Optimizer):
         __unused = p_copy
         # each direction is a list of tensors
         dim = len(directions)
-        # construct G (the inner products)
-        G = torch.zeros((dim, dim), requires_grad=False, device="cpu")
-        if self.option_tr == "p":
-            for i in range(dim):
-                for j in range(i, dim):
-                    for p in self._params:
-                        v = directions[i][p]
-                        u = directions[j][p]
-                        # compute G[i,j]
-                        G[i, j] += torch.mul(u, v).sum().cpu().detach()
-            # keep symmetry
-            for i in range(dim):
-                for j in range(i):
-                    G[i, j] = G[j, i]
-
-        else:
+        # construct G (the inner products) and c by GEMMs
+        #   of the (dim x n) direction matrix, kept on the device
+        with torch.no_grad():
+            flat_dirs = self._flatten(directions)
+            c = flat_dirs @ torch.cat([p.grad.reshape(-1) for p in self._params])
+            G = flat_dirs @ flat_dirs.T
+        if self.option_tr != "p":
             # simply use the eye matrix
-            for i in range(dim):
-                G[i, i] = 1.0
-
-        # construct c
-        c = torch.zeros(dim, requires_grad=False, device="cpu")
-        for i in range(dim):
-            for p in self._params:
-                u = directions[i][p]
-                c[i] += torch.mul(p.grad, u).sum().cpu().detach()
+            G = self._eye[:dim, :dim]
 
         if self.iter % self.decayrule.qp_freq != 0:
             # if set freq = 1
@@ -376,9 +366,16 @@ class HSODM(torch.optim.Optimizer):
         else:
             if DRSOM_MODE_QP == 0:
                 with torch.enable_grad():
-                    Q = self.compute_Q_via_hvp(directions, style)
+                    Q = self.compute_Q_via_hvp(flat_dirs, style)
                     self.zero_grad()
+                # Q, c and G are moved to the host at once (a single sync)
+                QcG = to_host(torch.vstack([Q, c, G]))
+                Q, c, G = QcG[:dim], QcG[dim], QcG[dim + 1 :]
             elif DRSOM_MODE_QP == 1:
+                # the interpolation works on the host,
+                #   so c and G are moved there first (in one copy)
+                cG = to_host(torch.vstack([c, G]))
+                c, G = cG[0], cG[1:]
                 Q = self.compute_Q_via_interpolation(
                     directions,
                     p_copy=p_copy,
@@ -398,23 +395,19 @@ class HSODM(torch.optim.Optimizer):
 
     @drsom_timer
     def normalize(self, direction):
-        v_norm = torch.sqrt(
-            sum(torch.linalg.norm(v) ** 2 for p, v in direction.items())
-        )
+        v_norm = torch.sqrt(sum(torch.linalg.norm(v) ** 2 for v in direction))
         v_norm = 1 if v_norm == 0 else v_norm
-        return {p: v / v_norm for p, v in direction.items()}
+        return [v / v_norm for v in direction]
 
     def gather_normalized_grad(self, bool_normalized=False, alpha=1):
         if bool_normalized:
-            return self.normalize(
-                {p: alpha * p.grad.detach().clone() for p in self._params}
-            )
-        return {p: alpha * p.grad.detach().clone() for p in self._params}
+            return self.normalize([alpha * p.grad.detach() for p in self._params])
+        return [alpha * p.grad.detach() for p in self._params]
 
     def gather_normalize(self, k, bool_normalized=False):
         if bool_normalized:
-            return self.normalize({p: self.state[p][k] for p in self._params})
-        return {p: self.state[p][k] for p in self._params}
+            return self.normalize([self.state[p][k] for p in self._params])
+        return [self.state[p][k] for p in self._params]
 
     def step(self, closure=None):
         """
@@ -426,8 +419,6 @@ class HSODM(torch.optim.Optimizer):
         if closure is None:
             raise ValueError("must provide a closure for DRSOM")
         closure = torch.enable_grad()(closure)
-        if DRSOM_VERBOSE:
-            torch.autograd.set_detect_anomaly(True)
 
         #
         self.adjust_gamma_and_radius()
@@ -466,19 +457,17 @@ class HSODM(torch.optim.Optimizer):
                     self.gamma = max(self.gamma * self.adjrule.beta1, 1e-4)
                     self.radius = max(self.radius / np.sqrt(self.adjrule.beta1), 1e-12)
                     if DRSOM_VERBOSE:
-                        pprint(self.logline)
+                        print(format_logline(self.logline))
                     continue
                 alpha = self.alpha
 
                 # build direction
                 dim = len(directions)
-                d_new = {
-                    p: torch.zeros_like(p, requires_grad=False) for p in self._params
-                }
-                for p in self._params:
+                d_new = [torch.zeros_like(p, requires_grad=False) for p in self._params]
+                for idx, p in enumerate(self._params):
                     for i in range(dim):
-                        u = directions[i][p]
-                        d_new[p].add_(u, alpha=alpha[i])
+                        u = directions[i][idx]
+                        d_new[idx].add_(u, alpha=alpha[i])
 
                 self._use_new_d(d_new)
                 loss_est = closure(backward=False).detach().cpu()
@@ -528,13 +517,7 @@ class HSODM(torch.optim.Optimizer):
                     self.logline["f"] = "{:+.2e}".format(loss.item())
                     self.logline["k"] = "{:+6d}".format(self.iter)
                     self.logline["k0"] = iter_adj
-                    print(
-                        pd.DataFrame(
-                            data=[list(self.logline.values())],
-                            columns=self.logline.keys(),
-                            dtype=str,
-                        ).to_markdown(tablefmt="grid")
-                    )
+                    print(format_logline(self.logline))
                 if not acc_step:
                     # set back to old ~ trial step failed
                     self._set_param(p_copy)
@@ -0,0 +1,177 @@
+"""
+kernels of the small (2 or 3-dimensional) TRS/Regularized QP,
+  compiled by numba (if available) so that the tiny subproblem
+  does not pay the torch/LAPACK dispatch for every adjustment.
+@note:
+  - all arrays are float64 numpy arrays
+  - the 2-dimensional case is solved in closed form,
+    the 3-dimensional case (its solve and smallest eigenvalue) as well
+  - if numba is not installed, the kernels run as plain python
+"""
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+
+        return decorator
+
+
+@njit(cache=True)
+def eigvalsh_min_2d(Q, G):
+    """
+    the smallest generalized eigenvalue of (Q, G), G is positive definite,
+      i.e., the smaller root of det(Q - lmb * G) = 0
+    """
+    a = G[0, 0] * G[1, 1] - G[0, 1] * G[1, 0]
+    b = -(Q[0, 0] * G[1, 1] + Q[1, 1] * G[0, 0] - Q[0, 1] * G[1, 0] - Q[1, 0] * G[0, 1])
+    c = Q[0, 0] * Q[1, 1] - Q[0, 1] * Q[1, 0]
+    disc = np.sqrt(max(b * b - 4 * a * c, 0.0))
+    return (-b - disc) / (2 * a)
+
+
+@njit(cache=True)
+def eigvalsh_min_3d(A):
+    """
+    the smallest eigenvalue of a symmetric 3 x 3 matrix A,
+      by the trigonometric solution of the characteristic cubic
+    """
+    p1 = A[0, 1] ** 2 + A[0, 2] ** 2 + A[1, 2] ** 2
+    if p1 == 0:
+        # diagonal
+        return min(A[0, 0], A[1, 1], A[2, 2])
+    q = (A[0, 0] + A[1, 1] + A[2, 2]) / 3
+    p2 = (A[0, 0] - q) ** 2 + (A[1, 1] - q) ** 2 + (A[2, 2] - q) ** 2 + 2 * p1
+    p = np.sqrt(p2 / 6)
+    B = (A - q * np.eye(3)) / p
+    r = np.linalg.det(B) / 2
+    # r in [-1, 1] up to rounding
+    phi = np.arccos(min(max(r, -1.0), 1.0)) / 3
+    return q + 2 * p * np.cos(phi + 2 * np.pi / 3)
+
+
+@njit(cache=True)
+def solve_2d(M, b):
+    """
+    solve M x = b by the explicit inverse,
+      returns (x, False) if M is singular
+    """
+    x = np.zeros(2)
+    det = M[0, 0] * M[1, 1] - M[0, 1] * M[1, 0]
+    if det == 0:
+        return x, False
+    x[0] = (M[1, 1] * b[0] - M[0, 1] * b[1]) / det
+    x[1] = (M[0, 0] * b[1] - M[1, 0] * b[0]) / det
+    return x, True
+
+
+@njit(cache=True)
+def solve_3d(M, b):
+    """
+    solve M x = b by the adjugate (Cramer's rule),
+      returns (x, False) if M is singular
+    """
+    x = np.zeros(3)
+    c0 = M[1, 1] * M[2, 2] - M[1, 2] * M[2, 1]
+    c1 = M[1, 2] * M[2, 0] - M[1, 0] * M[2, 2]
+    c2 = M[1, 0] * M[2, 1] - M[1, 1] * M[2, 0]
+    det = M[0, 0] * c0 + M[0, 1] * c1 + M[0, 2] * c2
+    if det == 0:
+        return x, False
+    x[0] = (
+        c0 * b[0]
+        + (M[0, 2] * M[2, 1] - M[0, 1] * M[2, 2]) * b[1]
+        + (M[0, 1] * M[1, 2] - M[0, 2] * M[1, 1]) * b[2]
+    ) / det
+    x[1] = (
+        c1 * b[0]
+        + (M[0, 0] * M[2, 2] - M[0, 2] * M[2, 0]) * b[1]
+        + (M[0, 2] * M[1, 0] - M[0, 0] * M[1, 2]) * b[2]
+    ) / det
+    x[2] = (
+        c2 * b[0]
+        + (M[0, 1] * M[2, 0] - M[0, 0] * M[2, 1]) * b[1]
+        + (M[0, 0] * M[1, 1] - M[0, 1] * M[1, 0]) * b[2]
+    ) / det
+    return x, True
+
+
+@njit(cache=True)
+def norm_g(alpha, G):
+    return np.sqrt(alpha @ (G @ alpha))
+
+
+@njit(cache=True)
+def eigvalsh_min(Q, G):
+    """
+    the smallest generalized eigenvalue of (Q, G), G is positive definite;
+      a larger problem is reduced to a standard one by the Cholesky factor of G
+    """
+    if Q.shape[0] == 2:
+        return eigvalsh_min_2d(Q, G)
+    Li = np.linalg.inv(np.linalg.cholesky(G))
+    A = Li @ Q @ Li.T
+    if Q.shape[0] == 3:
+        return eigvalsh_min_3d((A + A.T) / 2)
+    return np.linalg.eigvalsh(A)[0]
+
+
+@njit(cache=True)
+def solve(M, b):
+    """
+    solve M x = b, returns (x, False) if M is singular
+    """
+    if M.shape[0] == 2:
+        return solve_2d(M, b)
+    if M.shape[0] == 3:
+        return solve_3d(M, b)
+    if np.linalg.det(M) == 0:
+        return np.zeros(b.shape[0]), False
+    return np.linalg.solve(M, b), True
+
+
+@njit(cache=True)
+def compute_root(Q, c, gamma, G):
+    """
+    the radius free mode, see TRS._compute_root
+    Returns:
+      (lmb, alpha, norm)
+    """
+    lmin = eigvalsh_min(Q, G)
+    lb = max(0.0, -lmin)
+    lmax = lb + 1e4
+    _lmb_this = gamma * lmax + max(1 - gamma, 0.0) * lb
+    alpha, ok = solve(Q + G * _lmb_this, -c)
+    if not ok:
+        alpha, ok = solve(Q + G * (_lmb_this + 1e-4), -c)
+    return _lmb_this, alpha, norm_g(alpha, G)
+
+
+@njit(cache=True)
+def compute_root_tr(Q, c, delta, G):
+    """
+    the trust-region mode, see TRS._compute_root_tr
+    Returns:
+      (it, lmb, alpha, norm)
+    """
+    lmin = eigvalsh_min(Q, G)
+    lb = max(0.0, lmin)
+    ub = lb + 1e1
+    it = 0
+    gamma = 1e-1
+    alpha = np.zeros(c.shape[0])
+    while True:
+        _lmb_this = lb * (1 - gamma) + gamma * ub
+        _alpha, ok = solve(Q + G * _lmb_this, -c)
+        if ok:
+            alpha = _alpha
+        norm = norm_g(alpha, G)
+        if norm < delta or it > 10:
+            break
+        gamma *= 5
+        it += 1
+    return it, _lmb_this, alpha, norm
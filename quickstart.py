@@ -140,10 +140,14 @@ def train(dataloader, name, model, loss_fn, optimizer, args):
     avg_loss = 0
     for batch, (X, y) in enumerate(dataloader):
         X, y = X.to(device), y.to(device)
+        # the output of the forward pass in the closure,
+        #   the accuracy is thus measured before the update
+        cache = {}
 
         def closure(backward=True):
             optimizer.zero_grad()
             output = model(X)
+            cache["output"] = output.detach()
             loss = loss_fn(output, y)
             loss.backward()
             return loss
@@ -154,8 +158,7 @@ def train(dataloader, name, model, loss_fn, optimizer, args):
         avg_loss += loss.item()
 
         # compute prediction error
-        outputs = model(X)
-        _, predicted = outputs.max(1)
+        _, predicted = cache["output"].max(1)
         total += y.size(0)
         correct += predicted.eq(y).sum().item()
 
@@ -180,30 +183,57 @@ def train_drsom(dataloader, name, model, loss_fn, optimizer, ninterval):
     correct = 0
     total = 0
     avg_loss = 0
+    # the interpolation samples can be evaluated in a batch (by vmap)
+    #   if the model is a pure function of its parameters;
+    #   BatchNorm updates its running statistics in-place, which vmap forbids.
+    names = [n for n, p in model.named_parameters() if p.requires_grad]
+    params = list(model.parameters())
+    bool_functional = hasattr(torch, "func") and not any(
+        isinstance(m, nn.modules.batchnorm._BatchNorm) for m in model.modules()
+    )
     for batch, (X, y) in enumerate(dataloader):
         X, y = X.to(device), y.to(device)
+        # the output of the last evaluation and the versions of the parameters it saw,
+        #   reused for the accuracy only if the parameters are unchanged since
+        cache = {}
 
         def closure(backward=True):
             optimizer.zero_grad()
             output = model(X)
+            cache["output"] = output.detach()
+            cache["versions"] = [p._version for p in params]
             loss = loss_fn(output, y)
             if not backward:
                 return loss
-            if optimizer.qpmode in {DRSOMModeQP.AutomaticDiff, DRSOMModeQP.FiniteDiff}:
-                # only need for hvp
+            if not bool_functional and (
+                optimizer.qpmode in {DRSOMModeQP.AutomaticDiff, DRSOMModeQP.FiniteDiff}
+                or DRSOM_DEBUG_Q_CHECK
+            ):
+                # only need for hvp (by reverse-over-reverse),
+                #   a functional closure uses forward-over-reverse instead
                 loss.backward(create_graph=True)
             else:
                 loss.backward()
             return loss
 
+        def functional(params):
+            output = torch.func.functional_call(model, dict(zip(names, params)), (X,))
+            return loss_fn(output, y)
+
+        if bool_functional:
+            closure.functional = functional
+
         # backpropagation
 
         loss = optimizer.step(closure=closure)
         avg_loss += loss.item()
 
-        # compute prediction error
-        outputs = model(X)
-        _, predicted = outputs.max(1)
+        # compute prediction error,
+        #   a rejected or restored iterate needs a fresh forward pass
+        if cache.get("versions") != [p._version for p in params]:
+            with torch.no_grad():
+                cache["output"] = model(X)
+        _, predicted = cache["output"].max(1)
         total += y.size(0)
         correct += predicted.eq(y).sum().item()
 
@@ -0,0 +1,37 @@
+import torch
+from torch import nn
+
+from pydrsom.drsom import DRSOMB
+from pydrsom.drsom_utils import DRSOMModeQP
+
+
+class PartlyUsed(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.used = nn.Linear(4, 1)
+        self.unused = nn.Linear(4, 1)
+
+    def forward(self, x):
+        return self.used(x)
+
+
+def test_unused_parameter_has_a_zero_gradient():
+    torch.manual_seed(0)
+    X = torch.randn(16, 4)
+    y = torch.randn(16, 1)
+    for qpmode in (DRSOMModeQP.AutomaticDiff, DRSOMModeQP.Interpolation):
+        model = PartlyUsed()
+        unused = [p.clone() for p in model.unused.parameters()]
+        opt = DRSOMB(model.parameters(), qpmode=qpmode)
+
+        def closure(backward=True):
+            opt.zero_grad(set_to_none=True)
+            loss = ((model(X) - y) ** 2).mean()
+            if backward:
+                loss.backward(create_graph=qpmode == DRSOMModeQP.AutomaticDiff)
+            return loss
+
+        for _ in range(3):
+            opt.step(closure=closure)
+        for p, p0 in zip(model.unused.parameters(), unused):
+            assert torch.equal(p, p0)
@@ -0,0 +1,26 @@
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from pydrsom.drsom_vec import DRSOM
+
+
+def test_default_options_decrease_the_loss():
+    # the options default to the environment variables of drsom_utils.py
+    torch.manual_seed(0)
+    X = torch.randn(128, 10)
+    y = (X[:, 0] + X[:, 1] > 0).long()
+    model = nn.Sequential(nn.Linear(10, 16), nn.Tanh(), nn.Linear(16, 2))
+    opt = DRSOM(model.parameters())
+
+    def closure(backward=True):
+        opt.zero_grad()
+        loss = F.cross_entropy(model(X), y)
+        if backward:
+            loss.backward(create_graph=True)
+        return loss
+
+    loss0 = closure(backward=False).item()
+    for _ in range(10):
+        loss = opt.step(closure=closure)
+    assert loss.item() < loss0
@@ -0,0 +1,65 @@
+import numpy as np
+import torch
+from torch import nn
+
+from pydrsom.drsom import DRSOMB
+from pydrsom.drsom_utils import DRSOMMode
+
+
+def test_interpolation_rank_deficient_basis_matches_lstsq():
+    # three directions (-g, momentum_g, momentum): the 8 x 6 basis K has rank 4
+    torch.manual_seed(0)
+    torch.set_default_dtype(torch.float64)
+    try:
+        X = torch.randn(32, 5)
+        y = torch.randn(32, 1)
+        model = nn.Linear(5, 1)
+        opt = DRSOMB(model.parameters(), mode=DRSOMMode.MomGandMom)
+        assert opt._dim == 3
+
+        losses = []
+
+        def closure(backward=True):
+            loss = ((model(X) - y) ** 2).mean()
+            losses.append(loss.item())
+            return loss
+
+        samples = []
+        build_natural_basis = opt.build_natural_basis
+
+        def record(a):
+            samples.append(a)
+            return build_natural_basis(a)
+
+        opt.build_natural_basis = record
+
+        with torch.no_grad():
+            opt._D.copy_(torch.randn_like(opt._D))
+        flat_dirs = opt._D
+        fx = closure().item()
+        losses.clear()
+        c = torch.randn(3)
+        Q = opt.compute_Q_via_interpolation(
+            opt._D_views,
+            flat_dirs,
+            fx=fx,
+            c=c,
+            p_copy=opt._clone_param(),
+            closure=closure,
+            delta=opt.delta,
+        )
+
+        (a,) = samples
+        K = build_natural_basis(a)
+        assert np.linalg.matrix_rank(K) < K.shape[1]
+        df = np.array(losses) - fx - np.asarray(a) @ c.numpy()
+        q, *_ = np.linalg.lstsq(K, df, rcond=None)
+        Q_ref = np.zeros((3, 3))
+        iu = np.triu_indices(3)
+        Q_ref[iu] = q
+        Q_ref[iu[::-1]] = q
+
+        assert np.all(np.isfinite(Q.numpy()))
+        np.testing.assert_allclose(Q.numpy(), Q_ref, rtol=1e-8, atol=1e-10)
+    finally:
+        torch.set_default_dtype(torch.float32)
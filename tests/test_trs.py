@@ -0,0 +1,18 @@
+import numpy as np
+import torch
+
+from pydrsom.drsom_utils import TRS
+
+
+def test_zero_middle_direction_takes_the_fallback():
+    # e.g. momentum_g is still zero while momentum is not: G = diag(1, 0, 1)
+    Q = torch.tensor([[2.0, 0.0, 0.5], [0.0, 1.0, 0.0], [0.5, 0.0, 1.0]])
+    c = torch.tensor([1.0, 0.0, -1.0])
+    G = torch.diag(torch.tensor([1.0, 0.0, 1.0]))
+    assert not TRS._bool_small(c, G)
+
+    *_, alpha, norm, _ = TRS._compute_root(Q, c, 0.5, G)
+    assert np.isfinite(alpha.numpy()).all() and np.isfinite(norm)
+
+    *_, alpha, norm, _ = TRS._compute_root_tr(Q, c, 1.0, G)
+    assert np.isfinite(alpha.numpy()).all() and np.isfinite(norm)